@@ -1,10 +1,18 @@
 from fastapi import FastAPI, Request, Header, HTTPException
-from pydantic import BaseModel
-from typing import Optional
-import psycopg2
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, StreamingResponse
+from typing import List, Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+import asyncpg
+import msgspec
+import orjson
 import time
 import hashlib
+import hmac
 import os
+import re
 
 # ==========================
 # CONFIG
@@ -20,23 +28,28 @@ if not DATABASE_URL:
 if not LICENSE_SECRET or not ADMIN_KEY:
     raise RuntimeError("LICENSE_SECRET or ADMIN_KEY not set")
 
-# ==========================
-# APP
-# ==========================
+# sign() runs on every verify; make sure it uses OpenSSL's
+# hardware-accelerated SHA-256 rather than the builtin fallback
+if hashlib.sha256.__module__ != "_hashlib":
+    raise RuntimeError("hashlib is not backed by OpenSSL")
 
-app = FastAPI()
+SECRET_BYTES = LICENSE_SECRET.encode()
+ADMIN_KEY_BYTES = ADMIN_KEY.encode()
 
 # ==========================
 # DATABASE
 # ==========================
 
-def db():
-    return psycopg2.connect(DATABASE_URL)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Connections are opened once and reused across requests
+    app.state.pool = await asyncpg.create_pool(
+        DATABASE_URL, min_size=10, max_size=50
+    )
 
-# Create table on startup
-with db() as conn:
-    with conn.cursor() as cur:
-        cur.execute("""
+    # Create table on startup
+    async with app.state.pool.acquire() as conn:
+        await conn.execute("""
             CREATE TABLE IF NOT EXISTS licenses (
                 key TEXT PRIMARY KEY,
                 expires BIGINT,
@@ -44,167 +57,414 @@ with db() as conn:
                 revoked BOOLEAN DEFAULT FALSE
             )
         """)
-        conn.commit()
+
+    try:
+        yield
+    finally:
+        await app.state.pool.close()
+
+# ==========================
+# APP
+# ==========================
+
+app = FastAPI(lifespan=lifespan)
+
+# ==========================
+# LOOKUP CACHE
+# ==========================
+
+# Rows are invalidated locally on every write; the TTL bounds how long
+# changes made by other server processes can go unnoticed
+LOOKUP_CACHE_SIZE = 10_000
+LOOKUP_CACHE_TTL = 30
+
+_lookup_cache = OrderedDict()
+
+# Bumped by every invalidate(); a read that was in flight across a bump
+# may have fetched a row from before the write and must not be cached
+_cache_generation = 0
+
+def _cache_get(key: str, now: float) -> Optional[tuple]:
+    hit = _lookup_cache.get(key)
+    if hit is not None and hit[0] > now:
+        _lookup_cache.move_to_end(key)
+        return hit[1]
+    return None
+
+def _cache_put(key: str, row, now: float, generation: int) -> Optional[tuple]:
+    # Unknown keys are not cached so random guesses cannot evict real ones
+    if row is None:
+        _lookup_cache.pop(key, None)
+        return None
+
+    row = tuple(row)
+    if generation != _cache_generation:
+        return row
+
+    _lookup_cache[key] = (now + LOOKUP_CACHE_TTL, row)
+    _lookup_cache.move_to_end(key)
+    if len(_lookup_cache) > LOOKUP_CACHE_SIZE:
+        _lookup_cache.popitem(last=False)
+
+    return row
+
+async def lookup(key: str) -> Optional[tuple]:
+    now = time.monotonic()
+
+    row = _cache_get(key, now)
+    if row is not None:
+        return row
+
+    generation = _cache_generation
+    row = await app.state.pool.fetchrow(
+        "SELECT expires, hwid, revoked FROM licenses WHERE key = $1",
+        key
+    )
+    return _cache_put(key, row, now, generation)
+
+async def lookup_many(keys: List[str]) -> dict:
+    now = time.monotonic()
+
+    rows = {}
+    missing = []
+    for key in keys:
+        row = _cache_get(key, now)
+        if row is not None:
+            rows[key] = row
+        else:
+            missing.append(key)
+
+    if missing:
+        generation = _cache_generation
+        fetched = await app.state.pool.fetch(
+            "SELECT key, expires, hwid, revoked FROM licenses "
+            "WHERE key = ANY($1::text[])",
+            missing
+        )
+        for r in fetched:
+            rows[r[0]] = _cache_put(
+                r[0], (r[1], r[2], r[3]), now, generation
+            )
+
+    return rows
+
+def invalidate(key: str):
+    global _cache_generation
+    _cache_generation += 1
+    _lookup_cache.pop(key, None)
 
 # ==========================
 # SIGNATURE
 # ==========================
 
+# Keyed once; copying it skips re-hashing the padded secret on every call
+_SIGN_BASE = hmac.new(SECRET_BYTES, digestmod="sha256")
+
+# Licenses share few distinct expiry values, so most calls are cache hits
+@lru_cache(maxsize=4096)
 def sign(valid: bool, expires: int) -> str:
-    msg = f"{valid}|{expires}"
-    return hashlib.sha256((msg + LICENSE_SECRET).encode()).hexdigest()
+    h = _SIGN_BASE.copy()
+    h.update(b"%s|%d" % (b"True" if valid else b"False", expires))
+    return h.hexdigest()
+
+# Verify responses only depend on (valid, expires), so their encoded
+# bodies are cached alongside the signatures
+@lru_cache(maxsize=4096)
+def verify_body(valid: bool, expires: int) -> bytes:
+    return orjson.dumps({
+        "valid": valid,
+        "expires": expires,
+        "signature": sign(valid, expires)
+    })
+
+def verify_response(valid: bool, expires: int) -> Response:
+    return Response(verify_body(valid, expires), media_type="application/json")
+
+_NOT_FOUND_BODY = verify_body(False, 0)
 
 # ==========================
 # MODELS
 # ==========================
 
-class VerifyPayload(BaseModel):
+# Oversized input is rejected before it reaches the cache or the database.
+# Only lengths are bounded: stored keys and HWIDs were never held to a format.
+# NUL is the exception, since Postgres text cannot store it at all
+MAX_LICENSE_LEN = 256
+MAX_HWID_LEN = 256
+
+class VerifyPayload(msgspec.Struct):
     license: str
     hwid: str
     ts: int
 
-class CreatePayload(BaseModel):
+class VerifyBatchPayload(msgspec.Struct):
+    items: List[VerifyPayload]
+
+class CreatePayload(msgspec.Struct):
     license: str
     expires: int
 
+# strict=False accepts the same coercions Pydantic did ("123" or 1.0 for int)
+_verify_decoder = msgspec.json.Decoder(VerifyPayload, strict=False)
+_verify_batch_decoder = msgspec.json.Decoder(VerifyBatchPayload, strict=False)
+_create_decoder = msgspec.json.Decoder(CreatePayload, strict=False)
+
+def request_body(type_) -> dict:
+    # Handlers read the raw Request, so FastAPI cannot see the body model;
+    # describe it in the OpenAPI schema with the definitions inlined
+    (schema,), defs = msgspec.json.schema_components(
+        [type_], ref_template="{name}"
+    )
+
+    def inline(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return inline(defs[node["$ref"]])
+            return {k: inline(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [inline(v) for v in node]
+        return node
+
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": inline(schema)}}
+        }
+    }
+
+def well_formed(payload: VerifyPayload) -> bool:
+    return (
+        0 < len(payload.license) <= MAX_LICENSE_LEN
+        and len(payload.hwid) <= MAX_HWID_LEN
+        and "\x00" not in payload.license
+        and "\x00" not in payload.hwid
+    )
+
+def reject_nul(value: str, loc: list):
+    if "\x00" in value:
+        raise RequestValidationError([{
+            "type": "value_error",
+            "loc": loc,
+            "msg": "Value must not contain NUL characters"
+        }])
+
+_ERROR_PATH_RE = re.compile(r"\.([^.\[]+)|\[(\d+)\]")
+_ERROR_BYTE_RE = re.compile(r"\(byte (\d+)\)")
+_MISSING_FIELD = "Object missing required field `"
+
+def validation_errors(body: bytes, e: msgspec.DecodeError) -> list:
+    # Rebuild FastAPI's {"loc", "msg", "type"} error list from msgspec's
+    # message, e.g. "Expected `int`, got `str` - at `$.items[0].ts`"
+    if not body:
+        return [{"type": "missing", "loc": ["body"], "msg": "Field required"}]
+
+    msg = str(e)
+    if not isinstance(e, msgspec.ValidationError):
+        byte = _ERROR_BYTE_RE.search(msg)
+        return [{
+            "type": "json_invalid",
+            "loc": ["body", int(byte.group(1)) if byte else 0],
+            "msg": "JSON decode error",
+            "ctx": {"error": msg}
+        }]
+
+    msg, _, path = msg.partition(" - at `$")
+    loc = ["body"]
+    for name, index in _ERROR_PATH_RE.findall(path.rstrip("`")):
+        loc.append(name if name else int(index))
+
+    if msg.startswith(_MISSING_FIELD):
+        loc.append(msg[len(_MISSING_FIELD):].rstrip("`"))
+        return [{"type": "missing", "loc": loc, "msg": "Field required"}]
+
+    return [{"type": "value_error", "loc": loc, "msg": msg}]
+
+async def decode(request: Request, decoder: msgspec.json.Decoder):
+    body = await request.body()
+    try:
+        return decoder.decode(body)
+    except msgspec.DecodeError as e:
+        raise RequestValidationError(validation_errors(body, e))
+
 # ==========================
 # ADMIN AUTH
 # ==========================
 
 def admin_auth(key: Optional[str]):
-    if key != ADMIN_KEY:
+    if key is None or not hmac.compare_digest(key.encode(), ADMIN_KEY_BYTES):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 # ==========================
 # ADMIN ENDPOINTS
 # ==========================
 
-@app.post("/admin/create")
-def create_license(
-    payload: CreatePayload,
+@app.post("/admin/create", openapi_extra=request_body(CreatePayload))
+async def create_license(
+    request: Request,
     x_admin_key: Optional[str] = Header(None)
 ):
     admin_auth(x_admin_key)
 
-    with db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO licenses (key, expires, hwid, revoked)
-                VALUES (%s, %s, NULL, FALSE)
-                ON CONFLICT (key)
-                DO UPDATE SET
-                    expires = EXCLUDED.expires,
-                    revoked = FALSE
-            """, (payload.license, payload.expires))
-            conn.commit()
+    payload = await decode(request, _create_decoder)
+    reject_nul(payload.license, ["body", "license"])
+
+    await app.state.pool.execute("""
+        INSERT INTO licenses (key, expires, hwid, revoked)
+        VALUES ($1, $2, NULL, FALSE)
+        ON CONFLICT (key)
+        DO UPDATE SET
+            expires = EXCLUDED.expires,
+            revoked = FALSE
+    """, payload.license, payload.expires)
+    invalidate(payload.license)
 
     return {"status": "created", "license": payload.license}
 
 
 @app.post("/admin/revoke")
-def revoke_license(
+async def revoke_license(
     license: str,
     x_admin_key: Optional[str] = Header(None)
 ):
     admin_auth(x_admin_key)
+    reject_nul(license, ["query", "license"])
 
-    with db() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE licenses SET revoked = TRUE WHERE key = %s",
-                (license,)
-            )
-            conn.commit()
+    await app.state.pool.execute(
+        "UPDATE licenses SET revoked = TRUE WHERE key = $1",
+        license
+    )
+    invalidate(license)
 
     return {"status": "revoked", "license": license}
 
 
+LIST_BATCH = 1000
+
+async def stream_licenses():
+    sep = b"["
+    chunk = []
+
+    # Rows are pulled from a server-side cursor so the table is never
+    # held in memory all at once
+    async with app.state.pool.acquire() as conn:
+        async with conn.transaction():
+            async for r in conn.cursor(
+                "SELECT key, expires, hwid, revoked FROM licenses",
+                prefetch=LIST_BATCH
+            ):
+                chunk.append(sep + orjson.dumps({
+                    "license": r[0],
+                    "expires": r[1],
+                    "hwid": r[2],
+                    "revoked": r[3]
+                }))
+                sep = b","
+
+                if len(chunk) >= LIST_BATCH:
+                    yield b"".join(chunk)
+                    chunk = []
+
+    chunk.append(b"[]" if sep == b"[" else b"]")
+    yield b"".join(chunk)
+
+
 @app.get("/admin/licenses")
-def list_licenses(
+async def list_licenses(
     x_admin_key: Optional[str] = Header(None)
 ):
     admin_auth(x_admin_key)
 
-    with db() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT key, expires, hwid, revoked FROM licenses"
-            )
-            rows = cur.fetchall()
-
-    return [
-        {
-            "license": r[0],
-            "expires": r[1],
-            "hwid": r[2],
-            "revoked": r[3]
-        }
-        for r in rows
-    ]
+    return StreamingResponse(stream_licenses(), media_type="application/json")
 
 # ==========================
 # VERIFY ENDPOINT
 # ==========================
 
-@app.post("/api/license/verify")
-def verify_license(payload: VerifyPayload):
-    now = int(time.time())
-
-    with db() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT expires, hwid, revoked FROM licenses WHERE key = %s",
-                (payload.license,)
-            )
-            row = cur.fetchone()
+MAX_BATCH = 100
 
+async def check_license(
+    payload: VerifyPayload,
+    row: Optional[tuple],
+    now: int
+) -> tuple:
     # License not found
     if not row:
-        return {
-            "valid": False,
-            "expires": 0,
-            "signature": sign(False, 0)
-        }
+        return False, 0
 
     expires, hwid, revoked = row
 
     # Revoked
     if revoked:
-        return {
-            "valid": False,
-            "expires": expires,
-            "signature": sign(False, expires)
-        }
+        return False, expires
 
     # Expired
     if expires < now:
-        return {
-            "valid": False,
-            "expires": expires,
-            "signature": sign(False, expires)
-        }
+        return False, expires
 
-    # First HWID bind
+    # First HWID bind (atomic: if another client bound first, theirs wins)
     if hwid is None:
-        with db() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "UPDATE licenses SET hwid = %s WHERE key = %s",
-                    (payload.hwid, payload.license)
-                )
-                conn.commit()
-
-    # HWID mismatch
-    elif hwid != payload.hwid:
-        return {
-            "valid": False,
-            "expires": expires,
-            "signature": sign(False, expires)
-        }
+        hwid = await app.state.pool.fetchval("""
+            UPDATE licenses
+            SET hwid = COALESCE(hwid, $1)
+            WHERE key = $2 AND revoked = FALSE
+            RETURNING hwid
+        """, payload.hwid, payload.license)
+        invalidate(payload.license)
+
+    # HWID mismatch (compared as bytes: compare_digest rejects non-ASCII str)
+    if hwid is None or not hmac.compare_digest(
+        hwid.encode(), payload.hwid.encode()
+    ):
+        return False, expires
 
     # VALID
-    return {
-        "valid": True,
-        "expires": expires,
-        "signature": sign(True, expires)
-    }
+    return True, expires
+
+
+@app.post("/api/license/verify", openapi_extra=request_body(VerifyPayload))
+async def verify_license(request: Request):
+    payload = await decode(request, _verify_decoder)
+
+    if not well_formed(payload):
+        return Response(_NOT_FOUND_BODY, media_type="application/json")
+
+    now = int(time.time())
+
+    row = await lookup(payload.license)
+    if not row:
+        return Response(_NOT_FOUND_BODY, media_type="application/json")
+
+    valid, expires = await check_license(payload, row, now)
+    return verify_response(valid, expires)
+
+
+@app.post(
+    "/api/license/verify_batch",
+    openapi_extra=request_body(VerifyBatchPayload)
+)
+async def verify_license_batch(request: Request):
+    payload = await decode(request, _verify_batch_decoder)
+
+    if len(payload.items) > MAX_BATCH:
+        raise HTTPException(status_code=400, detail="Too many items")
+
+    now = int(time.time())
+
+    rows = await lookup_many(
+        [item.license for item in payload.items if well_formed(item)]
+    )
+
+    # Each result is the same cached body the single verify would return
+    bodies = []
+    for item in payload.items:
+        if not well_formed(item):
+            bodies.append(_NOT_FOUND_BODY)
+            continue
+
+        valid, expires = await check_license(item, rows.get(item.license), now)
+        bodies.append(verify_body(valid, expires))
+
+    return Response(
+        b'{"results":[' + b",".join(bodies) + b"]}",
+        media_type="application/json"
+    )